@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import sys
+
+from process.control import send_command
+
+parser = argparse.ArgumentParser(description='Control a running downloader.py through its --control-socket.')
+parser.add_argument('--socket', required=True, help='Path of the socket passed to downloader.py with --control-socket.')
+subparsers = parser.add_subparsers(dest='command', required=True)
+subparsers.add_parser('status', help='Show the settings, queued targets and videos, and in-flight downloads.')
+subparsers.add_parser('pause', help="Don't start any new downloads. Running downloads are allowed to finish.")
+subparsers.add_parser('resume', help='Start downloading again after a pause.')
+set_parser = subparsers.add_parser('set', help='Change settings of the running program.')
+set_parser.add_argument('--threads', type=int, help='How many downloads to run at once.')
+set_parser.add_argument('--sleep', type=float, help='How many minutes to sleep when in daemon mode.')
+set_parser.add_argument('--max-size', type=int, help='Max allowed size of a video in MB. Applies to downloads started after the change.')
+bump_target_parser = subparsers.add_parser('bump-target', help='Move a target to the front of the queue.')
+bump_target_parser.add_argument('url')
+bump_video_parser = subparsers.add_parser('bump-video', help='Move a video to the front of the queue.')
+bump_video_parser.add_argument('id')
+poll_parser = subparsers.add_parser('poll', help='Poll a target now, even if the program is sleeping.')
+poll_parser.add_argument('url')
+args = parser.parse_args()
+
+request = {'command': args.command.replace('-', '_')}
+if args.command == 'set':
+    request.update({'threads': args.threads, 'sleep': args.sleep, 'max_size': args.max_size})
+elif args.command in ('bump-target', 'poll'):
+    request['url'] = args.url
+elif args.command == 'bump-video':
+    request['id'] = args.id
+
+try:
+    response = send_command(args.socket, request)
+except (FileNotFoundError, ConnectionRefusedError) as e:
+    print('Could not connect to the control socket:', e)
+    sys.exit(1)
+
+if not response['ok']:
+    print('Error:', response['error'])
+    sys.exit(1)
+if 'status' in response:
+    print(json.dumps(response['status'], indent=4))
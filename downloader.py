@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
+import functools
 import logging.config
 import math
 import os
+import queue
 import re
 import signal
 import subprocess
@@ -17,9 +20,13 @@ from appdirs import user_data_dir
 from tqdm.auto import tqdm
 
 import ydl.yt_dlp as ydl
+from process.control import ControlServer, RuntimeControl
 from process.funcs import get_silent_logger, remove_duplicates_from_playlist, restart_program, setup_file_logger
+from process.jobs import Heartbeat, JobStore, default_node_id
 from process.threads import bar_eraser, download_video
 from ydl.files import create_directories, resolve_path
+from ydl.formats import DEFAULT_POLICY, FormatPolicy
+from ydl.scan import scan_library
 
 
 def signal_handler(sig, frame):
@@ -42,7 +49,8 @@ parser = argparse.ArgumentParser()
 parser.add_argument('file', help='URL to download or path of a file containing the URLs of the videos to download.')
 parser.add_argument('--output', required=False, help='Output directory. Ignored paths specified in a YAML file.')
 parser.add_argument('--no-update', '-n', action='store_true', help='Don\'t update yt-dlp at launch.')
-parser.add_argument('--max-size', type=int, default=1100, help='Max allowed size of a video in MB.')
+parser.add_argument('--max-size', type=int, default=None, help='Max allowed size of a video in MB. Overrides max_size in --format-policy. Default: 1100.')
+parser.add_argument('--format-policy', default=None, help='Path to a YAML file with the codec, height, frame rate, and size preferences used to pick the format of each video.')
 parser.add_argument('--rm-cache', '-r', action='store_true', help='Delete the yt-dlp cache on start.')
 parser.add_argument('--threads', type=int, default=cpu_count(), help='How many download processes to use.')
 parser.add_argument('--daemon', '-d', action='store_true', help="Run in daemon mode. Disables progress bars sleeps for the amount of time specified in --sleep.")
@@ -55,6 +63,13 @@ parser.add_argument('--ratelimit-sleep', type=int, default=5, help='How many sec
 parser.add_argument('--input-datatype', choices=['auto', 'txt', 'yaml'], default='auto', help='The datatype of the input file. If set to auto, the file will be scanned for a URL on the firstline.'
                                                                                               'If is a URL, the filetype will be set to txt. If it is a key: value pair then the filetype will be set to yaml.')
 parser.add_argument('--log-dir', default=None, help='Where to store the logs. Must be set when --output is not.')
+parser.add_argument('--job-store', default=None, help='Path to a SQLite file shared by several nodes (e.g. on shared storage). Enables distributed mode where nodes lease targets and videos from the store instead of downloading everything themselves.')
+parser.add_argument('--node-id', default=default_node_id(), help='Unique name of this node in distributed mode. Defaults to <hostname>-<pid>.')
+parser.add_argument('--lease-time', type=float, default=300, help='How many seconds a lease on a target or video lasts without a heartbeat in distributed mode.')
+parser.add_argument('--max-attempts', type=int, default=3, help='How many times a video is handed out in distributed mode before it is marked as failed.')
+parser.add_argument('--control-socket', default=None, help='Path of a Unix socket to listen on for commands from control.py. Lets you pause, reprioritize, and change --threads, --sleep, and --max-size while running.')
+parser.add_argument('--scan-library', action='store_true', help='Scan the output directories for videos that are already downloaded and add them to the download archive. Use this to recover a lost or erased tracker. Only changed directories are rescanned after the first run.')
+parser.add_argument('--scan-workers', type=int, default=32, help='How many directories --scan-library reads at once.')
 parser.add_argument('--verbose', '-v', action='store_true')
 args = parser.parse_args()
 
@@ -74,6 +89,32 @@ else:
 
 args.download_cache_file_directory = resolve_path(args.download_cache_file_directory)
 
+format_policy_config = {}
+if args.format_policy:
+    args.format_policy = resolve_path(args.format_policy)
+    if not args.format_policy.exists():
+        print('Format policy file does not exist:', args.format_policy)
+        sys.exit(1)
+    with open(args.format_policy, 'r') as file:
+        try:
+            format_policy_config = yaml.safe_load(file) or {}
+        except yaml.YAMLError as e:
+            print('Failed to load format policy, error:', e)
+            sys.exit(1)
+    try:
+        FormatPolicy(format_policy_config)
+    except ValueError as e:
+        print('Invalid format policy:', e)
+        sys.exit(1)
+if args.max_size is None:
+    args.max_size = format_policy_config.get('max_size', DEFAULT_POLICY['max_size'])
+else:
+    try:
+        FormatPolicy(dict(format_policy_config, max_size=args.max_size))
+    except ValueError as e:
+        print('Invalid format policy:', e)
+        sys.exit(1)
+
 # TODO: use logging for this
 if args.verbose:
     print('Cache directory:', args.download_cache_file_directory)
@@ -120,6 +161,36 @@ else:
 # Create directories AFTER loading the file
 create_directories(*url_list.keys(), args.download_cache_file_directory)
 
+job_store = None
+if args.job_store:
+    args.job_store = resolve_path(args.job_store)
+    create_directories(args.job_store.parent)
+    job_store = JobStore(args.job_store, node_id=args.node_id, lease_time=args.lease_time, threads=args.threads, max_attempts=args.max_attempts)
+    heartbeat = Heartbeat(job_store)
+    heartbeat.start()
+
+
+    def close_job_store():
+        heartbeat.stop()
+        job_store.close()
+
+
+    atexit.register(close_job_store)
+
+control = RuntimeControl(threads=args.threads, sleep=args.sleep, max_size=args.max_size,
+                         targets=[(output_path, target_url) for output_path, urls in url_list.items() for target_url in urls],
+                         stats=job_store.stats if job_store else None)
+if args.control_socket:
+    args.control_socket = resolve_path(args.control_socket)
+    create_directories(args.control_socket.parent)
+    try:
+        control_server = ControlServer(control, args.control_socket)
+    except OSError as e:
+        print('Could not open the control socket:', e)
+        sys.exit(1)
+    control_server.start()
+    atexit.register(control_server.stop)
+
 
 def do_update():
     if not args.no_update:
@@ -137,6 +208,8 @@ if args.rm_cache:
 
 if args.daemon:
     print('Running in daemon mode.')
+if job_store:
+    print(f'Running in distributed mode as node "{args.node_id}" with job store {args.job_store}')
 
 create_directories(args.log_dir)
 
@@ -168,6 +241,16 @@ def load_existing_videos():
     return output
 
 
+download_archive_loggers = {}
+
+
+def get_download_archive_logger(playlist_id):
+    # Each playlist gets its own logger so a video ID is only written to its own playlist's archive.
+    if playlist_id not in download_archive_loggers:
+        download_archive_loggers[playlist_id] = setup_file_logger(f'download_archive_{playlist_id}', args.download_cache_file_directory / (str(playlist_id) + '.log'), format_str='%(message)s')
+    return download_archive_loggers[playlist_id]
+
+
 status_bar = tqdm(position=2, bar_format='{desc}', disable=args.daemon, leave=False)
 
 
@@ -217,10 +300,16 @@ class ytdl_logger(object):
         log_bar(msg, 'error')
 
 
+@functools.lru_cache(maxsize=None)
+def build_format(max_size):
+    # Only rebuilt when the max size is changed through the control socket.
+    return FormatPolicy(dict(format_policy_config, max_size=max_size), merge_output_format='mkv')
+
+
 # https://github.com/yt-dlp/yt-dlp#embedding-examples
 base_outtempl = '[%(id)s] [%(title)s] [%(uploader)s] [%(uploader_id)s].%(ext)s'  # leading dash can cause issues due to bash args so we surround the variables in brackets
 ydl_opts = {
-    'format': f'(bestvideo[filesize<{args.max_size}M][vcodec^=av01][height>=1080][fps>30]/bestvideo[filesize<{args.max_size}M][vcodec=vp9.2][height>=1080][fps>30]/bestvideo[filesize<{args.max_size}M][vcodec=vp9][height>=1080][fps>30]/bestvideo[filesize<{args.max_size}M][vcodec^=av01][height>=1080]/bestvideo[filesize<{args.max_size}M][vcodec=vp9.2][height>=1080]/bestvideo[filesize<{args.max_size}M][vcodec=vp9][height>=1080]/bestvideo[filesize<{args.max_size}M][height>=1080]/bestvideo[filesize<{args.max_size}M][vcodec^=av01][height>=720][fps>30]/bestvideo[filesize<{args.max_size}M][vcodec=vp9.2][height>=720][fps>30]/bestvideo[filesize<{args.max_size}M][vcodec=vp9][height>=720][fps>30]/bestvideo[filesize<{args.max_size}M][vcodec^=av01][height>=720]/bestvideo[filesize<{args.max_size}M][vcodec=vp9.2][height>=720]/bestvideo[filesize<{args.max_size}M][vcodec=vp9][height>=720]/bestvideo[filesize<{args.max_size}M][height>=720]/bestvideo[filesize<{args.max_size}M])+(bestaudio[acodec=opus]/bestaudio)/best',
+    'format': build_format(args.max_size),
     'merge_output_format': 'mkv',
     'logtostderr': True,
     'embedchapters': True,
@@ -257,9 +346,15 @@ for k, v in url_list.items():
 
 # Init bars
 video_bars = manager.list()
-if not args.daemon:
-    for i in range(args.threads):
-        video_bars.append([3 + i, manager.Lock()])
+
+
+def ensure_video_bars(count):
+    if not args.daemon:
+        while len(video_bars) < count:
+            video_bars.append([3 + len(video_bars), manager.Lock()])
+
+
+ensure_video_bars(args.threads)
 
 encountered_errors = 0
 errored_videos = 0
@@ -271,97 +366,200 @@ if not args.daemon:
     Thread(target=bar_eraser, args=(video_bars, eraser_exit,)).start()
 
 already_erased_downloaded_tracker = False
-
-while True:
-    do_update()
-    progress_bar = tqdm(total=url_count, position=0, desc='Inputs', disable=args.daemon, bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}')
-    for output_path, urls in url_list.items():
-        for target_url in urls:
-            logger.info('Fetching playlist...')
-            playlist = yt_dlp.playlist_contents(str(target_url))
-
-            if not playlist:
-                progress_bar.update()
-                continue
-
-            download_archive_file = args.download_cache_file_directory / (str(playlist['id']) + '.log')
-            if args.erase_downloaded_tracker and not already_erased_downloaded_tracker:
-                if download_archive_file.exists():
-                    os.remove(download_archive_file)
-                already_erased_downloaded_tracker = True
-            downloaded_videos = load_existing_videos()
-
-            msg = f'Found {len(downloaded_videos)} downloaded videos for playlist "{playlist["title"]}" ({playlist["id"]}). {"Ignoring." if args.ignore_downloaded else ""}'
+library = {}
+playlist_bar = None
+woken = False
+last_full_cycle = None
+
+
+def handle_result(result, job):
+    global encountered_errors, errored_videos
+
+    # Save the video ID to the file
+    if result['downloaded_video_id']:
+        get_download_archive_logger(job['playlist_id']).info(result['downloaded_video_id'])
+        if job_store and not job_store.complete_video(result['video_id'], job['output_path']):
+            log_info_twice(f"Lost the lease on {result['video_id']} before it finished downloading, leaving it to the node that holds it now.")
+    elif job_store and not job_store.fail_video(result['video_id'], job['output_path']):
+        log_info_twice(f"Lost the lease on {result['video_id']} before it finished downloading, leaving it to the node that holds it now.")
+
+    # Print stuff
+    for line in result['video_error_logger_msg']:
+        video_error_logger.info(line)
+        file_logger.error(line)
+        encountered_errors += 1
+        if not args.silence_errors:
             if args.daemon:
-                print(msg)
+                logger.error(line)
             else:
-                status_bar.write(msg)
-            download_archive_logger = setup_file_logger('download_archive', download_archive_file, format_str='%(message)s')
+                status_bar.write(line)
+
+    if len(result['video_error_logger_msg']):
+        errored_videos += 1
+        if args.silence_errors and args.daemon:
+            logger.error(f"{result['video_id']} failed due to error.")
+
+    # for line in result['status_msg']:
+    #     playlist_bar.write(line)
+    for line in result['logger_msg']:
+        log_info_twice(line)
 
-            playlist['entries'] = remove_duplicates_from_playlist(playlist['entries'])
 
-            log_info_twice(f'Downloading item: "{playlist["title"]}" ({playlist["id"]}) {target_url}')
+def run_downloads(next_job, bar=None):
+    """
+    Download jobs until `next_job()` returns None, keeping at most `control.threads` downloads running.
+    A job is a dict with the keys `video`, `output_path`, and `playlist_id`.
+    """
+    results = queue.Queue()
+    in_flight = 0
+    pool, pool_size, retired_pools = None, 0, []
+    if sys.stdout.isatty():
+        # Doesn't work if not connected to a terminal:
+        # OSError: [Errno 25] Inappropriate ioctl for device
+        status_bar.set_description_str('=' * os.get_terminal_size()[0])
+    logger.info('Starting downloads...')
+    exhausted = False
+    while True:
+        while not exhausted and not control.paused and in_flight < control.threads:
+            job = next_job()
+            if job is None:
+                exhausted = True
+                break
+            if control.threads > pool_size:
+                # The worker count was raised. Start a bigger pool and let the old one finish what it's running.
+                if pool:
+                    pool.close()
+                    retired_pools.append(pool)
+                pool_size = control.threads
+                ensure_video_bars(pool_size)
+                pool = Pool(processes=pool_size)
+            job_ydl_opts = ydl_opts.copy()
+            job_ydl_opts['outtmpl'] = f'{job["output_path"]}/{base_outtempl}'
+            job_ydl_opts['format'] = build_format(control.max_size)
+            control.start_job(job)
+            pool.apply_async(download_video, ((job['video'], {'bars': video_bars, 'ydl_opts': job_ydl_opts, 'output_dir': Path(job['output_path'])}),),
+                             callback=lambda r, j=job: results.put((r, j)),
+                             error_callback=lambda e, j=job: results.put(({'downloaded_video_id': None, 'video_id': j['video']['id'], 'video_error_logger_msg': [f'EXCEPTION -> {e}'], 'status_msg': [], 'logger_msg': []}, j)))
+            in_flight += 1
+        if not in_flight:
+            if exhausted:
+                break
+            # Paused with nothing running.
+            control.wait_while_paused(1)
+            continue
+        try:
+            # Don't block forever so changes made through the control socket are picked up while waiting.
+            result, job = results.get(timeout=1)
+        except queue.Empty:
+            continue
+        in_flight -= 1
+        control.finish_job(job)
+        handle_result(result, job)
+        if bar is not None:
+            bar.update()
+    for p in retired_pools + ([pool] if pool else []):
+        p.close()
+        p.join()
+
+
+def next_job_store_job():
+    bumped = control.take_bumped_videos()
+    if bumped:
+        job_store.prioritize_videos(bumped)
+    jobs = job_store.lease_videos(1)
+    return jobs[0] if jobs else None
 
-            # Remove already downloaded files from the to-do list.
-            download_queue = []
-            for p, video in enumerate(playlist['entries']):
-                if video['id'] not in download_queue:
-                    if not args.ignore_downloaded and video['id'] not in downloaded_videos:
-                        download_queue.append(video)
-                        # downloaded_videos.add(video['id'])
-                    elif args.ignore_downloaded:
-                        download_queue.append(video)
 
+while True:
+    do_update()
+    if args.scan_library:
+        scan_start = time.time()
+        library = scan_library(*[resolve_path(x) for x in url_list.keys()], workers=args.scan_workers, cache_file=args.download_cache_file_directory / 'library-scan.json')
+        log_info_twice(f'Found {sum(len(x["complete"]) for x in library.values())} videos on disk in {round(time.time() - scan_start, 2)}s.')
+    progress_bar = tqdm(total=url_count, position=0, desc='Inputs', disable=args.daemon, bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}')
+    # A cycle started by a `poll` command only polls the requested targets.
+    full_cycle = not woken
+    pending_targets = control.take_poll_requests() if woken else list(control.targets)
+    for output_path, target_url in iter(lambda: control.next_target(pending_targets), None):
+        control.wait_while_paused()
+        requested_poll = control.take_requested_poll((output_path, target_url))
+        if job_store and not job_store.lease_target(str(target_url), output_path, min_interval=control.sleep * 60 if args.daemon and not requested_poll else 0):
+            # Another node is polling this target or polled it recently.
+            progress_bar.update()
+            continue
+
+        logger.info('Fetching playlist...')
+        playlist = yt_dlp.playlist_contents(str(target_url))
+
+        if not playlist:
+            if job_store:
+                job_store.release_target(str(target_url), output_path, polled=False)
+            progress_bar.update()
+            continue
+
+        download_archive_file = args.download_cache_file_directory / (str(playlist['id']) + '.log')
+        if args.erase_downloaded_tracker and not already_erased_downloaded_tracker:
+            if download_archive_file.exists():
+                os.remove(download_archive_file)
+            already_erased_downloaded_tracker = True
+        downloaded_videos = load_existing_videos()
+
+        # Add the videos that are on disk but missing from the archive.
+        on_disk = library.get(str(resolve_path(output_path)), {}).get('complete', set())
+        found_on_disk = ({video['id'] for video in playlist['entries']} & on_disk) - downloaded_videos
+        if found_on_disk:
+            download_archive_logger = get_download_archive_logger(playlist['id'])
+            for video_id in sorted(found_on_disk):
+                download_archive_logger.info(video_id)
+            downloaded_videos.update(found_on_disk)
+            log_info_twice(f'Added {len(found_on_disk)} videos found on disk to the download archive for "{playlist["title"]}" ({playlist["id"]}).')
+
+        msg = f'Found {len(downloaded_videos)} downloaded videos for playlist "{playlist["title"]}" ({playlist["id"]}). {"Ignoring." if args.ignore_downloaded else ""}'
+        if args.daemon:
+            print(msg)
+        else:
+            status_bar.write(msg)
+
+        playlist['entries'] = remove_duplicates_from_playlist(playlist['entries'])
+
+        log_info_twice(f'Downloading item: "{playlist["title"]}" ({playlist["id"]}) {target_url}')
+
+        # Remove already downloaded files from the to-do list.
+        download_queue = []
+        for p, video in enumerate(playlist['entries']):
+            if video['id'] not in download_queue:
+                if not args.ignore_downloaded and video['id'] not in downloaded_videos:
+                    download_queue.append(video)
+                    # downloaded_videos.add(video['id'])
+                elif args.ignore_downloaded:
+                    download_queue.append(video)
+
+        if job_store:
+            # Hand the videos to the shared queue. They're downloaded by whichever node leases them.
+            queued = job_store.enqueue_videos(playlist['id'], output_path, download_queue, requeue=args.ignore_downloaded)
+            job_store.release_target(str(target_url), output_path)
+            log_info_twice(f'Queued {queued} videos for "{playlist["title"]}" ({playlist["id"]}) in the job store.')
+        else:
             playlist_bar = tqdm(total=len(playlist['entries']), position=1, desc=f'"{playlist["title"]}" ({playlist["id"]})', disable=args.daemon, leave=False)
             if not args.ignore_downloaded:
                 playlist_bar.update(len(downloaded_videos))
 
-            playlist_ydl_opts = ydl_opts.copy()
-            playlist_ydl_opts['outtmpl'] = f'{output_path}/{base_outtempl}'
-
             if len(download_queue):  # Don't mess with multiprocessing if all videos are already downloaded
-                with Pool(processes=args.threads) as pool:
-                    if sys.stdout.isatty():
-                        # Doesn't work if not connected to a terminal:
-                        # OSError: [Errno 25] Inappropriate ioctl for device
-                        status_bar.set_description_str('=' * os.get_terminal_size()[0])
-                    logger.info('Starting downloads...')
-                    for result in pool.imap_unordered(download_video, ((video, {'bars': video_bars, 'ydl_opts': playlist_ydl_opts, 'output_dir': Path(output_path), }) for video in download_queue)):
-                        # Save the video ID to the file
-                        if result['downloaded_video_id']:
-                            download_archive_logger.info(result['downloaded_video_id'])
-
-                        # Print stuff
-                        for line in result['video_error_logger_msg']:
-                            video_error_logger.info(line)
-                            file_logger.error(line)
-                            encountered_errors += 1
-                            if not args.silence_errors:
-                                if args.daemon:
-                                    logger.error(line)
-                                else:
-                                    status_bar.write(line)
-
-                        if len(result['video_error_logger_msg']):
-                            errored_videos += 1
-                            if args.silence_errors and args.daemon:
-                                logger.error(f"{result['video_id']} failed due to error.")
-
-                        # for line in result['status_msg']:
-                        #     playlist_bar.write(line)
-                        for line in result['logger_msg']:
-                            log_info_twice(line)
-                        playlist_bar.update()
+                jobs = [{'video': video, 'output_path': output_path, 'playlist_id': playlist['id']} for video in download_queue]
+                run_downloads(lambda: control.next_video(jobs), bar=playlist_bar)
             else:
                 status_bar.write(f"All videos already downloaded for '{playlist['title']}'.")
-            log_info_twice(f"Finished item: '{playlist['title']}' {target_url}")
+        log_info_twice(f"Finished item: '{playlist['title']}' {target_url}")
 
-            # Sleep a bit to prevent rate-limiting
-            if progress_bar.n < len(url_list.keys()) - 1:
-                status_bar.set_description_str(f'Sleeping {args.ratelimit_sleep}s...')
-                time.sleep(args.ratelimit_sleep)
+        # Sleep a bit to prevent rate-limiting
+        if progress_bar.n < len(url_list.keys()) - 1:
+            status_bar.set_description_str(f'Sleeping {args.ratelimit_sleep}s...')
+            time.sleep(args.ratelimit_sleep)
 
-            progress_bar.update()
+        progress_bar.update()
+    if job_store:
+        run_downloads(next_job_store_job)
+        log_info_twice(f'Job store status: {job_store.stats()}')
     error_msg = f'Encountered {encountered_errors} errors on {errored_videos} videos.'
     if args.daemon:
         logger.info(error_msg)
@@ -371,14 +569,19 @@ while True:
     if not args.daemon:
         break
     else:
-        logger.info(f'Sleeping for {args.sleep} min.')
+        if full_cycle:
+            last_full_cycle = time.time()
+        # Polls requested through the control socket don't push back the next full cycle.
+        sleep_seconds = max(last_full_cycle + control.sleep * 60 - time.time(), 0)
+        logger.info(f'Sleeping for {round(sleep_seconds / 60, 2)} min.')
         try:
-            time.sleep(args.sleep * 60)
+            woken = control.sleep_until_woken(sleep_seconds)
         except KeyboardInterrupt:
             sys.exit(0)
         # downloaded_videos = load_existing_videos()  # reload the videos that have already been downloaded
 
 # Clean up the remaining bars. Have to close them in order.
 eraser_exit.value = True
-playlist_bar.close()
+if playlist_bar:
+    playlist_bar.close()
 status_bar.close()
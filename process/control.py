@@ -0,0 +1,234 @@
+import json
+import math
+import os
+import socket
+import socketserver
+import stat
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Union
+
+
+class RuntimeControl:
+    """
+    Settings and queue state that can be changed while the program is running. The main loop reads from this object
+    instead of `args` and the control socket writes to it.
+    """
+
+    def __init__(self, threads: int, sleep: float, max_size: int, targets: list, stats=None):
+        self.lock = Lock()
+        self.threads = threads
+        self.sleep = sleep
+        self.max_size = max_size
+        self.targets = targets  # (output_path, url) pairs
+        self.stats = stats
+        self.running = Event()  # cleared while paused
+        self.running.set()
+        self.woken = Event()  # set to cut the daemon sleep short
+        self.bumped_targets = []
+        self.bumped_videos = []
+        self.poll_requests = []
+        self.requested_polls = set()  # polled targets that must skip the --sleep interval check
+        self.current_target = None
+        self.pending_targets = []
+        self.pending_videos = []
+        self.in_flight = {}
+
+    @property
+    def paused(self) -> bool:
+        return not self.running.is_set()
+
+    def wait_while_paused(self, timeout: float = None) -> bool:
+        return self.running.wait(timeout)
+
+    def sleep_until_woken(self, seconds: float) -> bool:
+        """
+        Sleep for `seconds` or until a poll is requested. Returns True if the sleep was cut short.
+        """
+        woken = self.woken.wait(seconds)
+        self.woken.clear()
+        return woken
+
+    def take_poll_requests(self) -> list:
+        with self.lock:
+            targets = [t for t in self.targets if str(t[1]) in self.poll_requests]
+            self.requested_polls.update(targets)
+            self.poll_requests.clear()
+            return targets
+
+    def take_requested_poll(self, target: tuple) -> bool:
+        """
+        Returns True if the target is being polled because of a `poll` command.
+        """
+        with self.lock:
+            if target in self.requested_polls:
+                self.requested_polls.remove(target)
+                return True
+            return False
+
+    def next_target(self, pending: list):
+        """
+        Pop the next target from `pending`. Targets that were requested to be polled are put back into the queue
+        and bumped targets are moved to the front.
+        """
+        with self.lock:
+            for target in [t for t in self.targets if str(t[1]) in self.poll_requests]:
+                if target not in pending:
+                    pending.append(target)
+                self.requested_polls.add(target)
+            self.bumped_targets.extend(self.poll_requests)
+            self.poll_requests.clear()
+            self.woken.clear()
+            front = [t for t in pending if str(t[1]) in self.bumped_targets]
+            for target in front:
+                pending.remove(target)
+            pending[:0] = front
+            self.bumped_targets = [url for url in self.bumped_targets if url not in [str(t[1]) for t in front]]
+            self.pending_targets = pending
+            self.current_target = pending.pop(0) if pending else None
+            return self.current_target
+
+    def next_video(self, pending: list):
+        """
+        Pop the next job from `pending`, preferring bumped videos.
+        """
+        with self.lock:
+            self.pending_videos = pending
+            for i, job in enumerate(pending):
+                if job['video']['id'] in self.bumped_videos:
+                    self.bumped_videos.remove(job['video']['id'])
+                    return pending.pop(i)
+            return pending.pop(0) if pending else None
+
+    def take_bumped_videos(self) -> list:
+        with self.lock:
+            videos = self.bumped_videos
+            self.bumped_videos = []
+            return videos
+
+    def start_job(self, job):
+        with self.lock:
+            self.in_flight[(job['video']['id'], job['output_path'])] = dict(job, started=time.time())
+
+    def finish_job(self, job):
+        with self.lock:
+            self.in_flight.pop((job['video']['id'], job['output_path']), None)
+
+    def status(self) -> dict:
+        with self.lock:
+            status = {
+                'paused': self.paused,
+                'threads': self.threads,
+                'sleep': self.sleep,
+                'max_size': self.max_size,
+                'current_target': list(self.current_target) if self.current_target else None,
+                'pending_targets': [list(t) for t in self.pending_targets],
+                'pending_videos': [job['video']['id'] for job in self.pending_videos],
+                'in_flight': [{
+                    'id': job['video']['id'],
+                    'title': job['video'].get('title'),
+                    'output_path': job['output_path'],
+                    'elapsed': round(time.time() - job['started']),
+                } for job in self.in_flight.values()],
+                'bumped_targets': list(self.bumped_targets),
+                'bumped_videos': list(self.bumped_videos),
+            }
+        if self.stats:
+            status['job_store'] = self.stats()
+        return status
+
+    def handle(self, request: dict) -> dict:
+        if not isinstance(request, dict):
+            return {'ok': False, 'error': 'Request must be a JSON object'}
+        command = request.get('command')
+        if command == 'status':
+            return {'ok': True, 'status': self.status()}
+        elif command == 'pause':
+            self.running.clear()
+        elif command == 'resume':
+            self.running.set()
+        elif command == 'set':
+            # Check every value before changing anything so a bad value doesn't leave the others half applied.
+            values = {}
+            for key, cast in (('threads', int), ('sleep', float), ('max_size', int)):
+                if request.get(key) is not None:
+                    value = float(request[key])
+                    if not math.isfinite(value) or cast(value) <= 0:
+                        return {'ok': False, 'error': f'{key} must be a finite number greater than 0'}
+                    values[key] = cast(value)
+            with self.lock:
+                for key, value in values.items():
+                    setattr(self, key, value)
+        elif command in ('bump_target', 'poll'):
+            url = request.get('url')
+            if url not in [str(t[1]) for t in self.targets]:
+                return {'ok': False, 'error': f'Unknown target: {url}'}
+            with self.lock:
+                if command == 'bump_target':
+                    self.bumped_targets.append(url)
+                else:
+                    self.poll_requests.append(url)
+            if command == 'poll':
+                self.woken.set()
+        elif command == 'bump_video':
+            if not request.get('id'):
+                return {'ok': False, 'error': 'Missing video ID'}
+            with self.lock:
+                self.bumped_videos.append(request['id'])
+        else:
+            return {'ok': False, 'error': f'Unknown command: {command}'}
+        return {'ok': True}
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        # One JSON object per line, one JSON reply per line.
+        for line in self.rfile:
+            try:
+                response = self.server.control.handle(json.loads(line))
+            except (ValueError, TypeError, OverflowError) as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class ControlServer(Thread):
+    """
+    Serves a RuntimeControl on a Unix domain socket.
+    """
+
+    def __init__(self, control: RuntimeControl, path: Union[str, Path]):
+        super().__init__(daemon=True)
+        self.path = Path(path)
+        if os.path.lexists(self.path):
+            if not stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                raise FileExistsError(f'Control socket path exists and is not a socket: {self.path}')
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(str(self.path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Left over from a previous run that didn't shut down cleanly.
+                os.remove(self.path)
+            else:
+                raise FileExistsError(f'Another instance is already listening on the control socket: {self.path}')
+        self.server = socketserver.ThreadingUnixStreamServer(str(self.path), _ControlHandler)
+        self.server.daemon_threads = True
+        self.server.control = control
+        os.chmod(self.path, 0o600)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.path.exists():
+            os.remove(self.path)
+
+
+def send_command(path: Union[str, Path], request: dict) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(str(path))
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as file:
+            return json.loads(file.readline())
@@ -0,0 +1,264 @@
+import os
+import socket
+import sqlite3
+import time
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id TEXT PRIMARY KEY,
+    hostname TEXT,
+    pid INTEGER,
+    threads INTEGER,
+    last_seen REAL
+);
+CREATE TABLE IF NOT EXISTS targets (
+    url TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    last_polled REAL,
+    PRIMARY KEY (url, output_path)
+);
+CREATE TABLE IF NOT EXISTS videos (
+    video_id TEXT NOT NULL,
+    output_path TEXT NOT NULL,
+    playlist_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    title TEXT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    priority INTEGER NOT NULL DEFAULT 0,
+    updated REAL,
+    PRIMARY KEY (video_id, output_path)
+);
+CREATE INDEX IF NOT EXISTS videos_status ON videos (status, lease_expires);
+"""
+
+
+def default_node_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class JobStore:
+    """
+    A SQLite file shared by every node in the fleet. Nodes take time-limited leases on targets (to poll them)
+    and on videos (to download them). A lease that isn't renewed by a heartbeat expires and the job is handed
+    to whichever node asks next, so a crashed node never holds work forever.
+    """
+
+    def __init__(self, path: Union[str, Path], node_id: str = None, lease_time: float = 300, threads: int = 1, max_attempts: int = 3):
+        self.path = Path(path)
+        self.node_id = node_id or default_node_id()
+        self.lease_time = lease_time
+        self.threads = threads
+        self.max_attempts = max_attempts
+        self._lock = Lock()
+        # The rollback journal is used instead of WAL since WAL doesn't work on network filesystems.
+        self._conn = sqlite3.connect(str(self.path), timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+            # Job stores created before videos could be prioritized.
+            if 'priority' not in [row['name'] for row in self._conn.execute('PRAGMA table_info(videos)')]:
+                self._conn.execute('ALTER TABLE videos ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+        self.heartbeat()
+
+    def _transaction(self, func, *args):
+        """
+        Run `func(cursor, now, *args)` inside a write transaction. BEGIN IMMEDIATE takes the write lock up front
+        so two nodes can't both read a job as free and then both claim it.
+        """
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                result = func(cur, time.time(), *args)
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+            cur.execute('COMMIT')
+            return result
+
+    def heartbeat(self):
+        """
+        Record that this node is alive and extend every lease it holds.
+        """
+
+        def _heartbeat(cur, now):
+            cur.execute('INSERT INTO nodes (node_id, hostname, pid, threads, last_seen) VALUES (?, ?, ?, ?, ?) '
+                        'ON CONFLICT (node_id) DO UPDATE SET threads = excluded.threads, last_seen = excluded.last_seen',
+                        (self.node_id, socket.gethostname(), os.getpid(), self.threads, now))
+            expires = now + self.lease_time
+            cur.execute('UPDATE targets SET lease_expires = ? WHERE lease_owner = ?', (expires, self.node_id))
+            cur.execute("UPDATE videos SET lease_expires = ? WHERE lease_owner = ? AND status = 'leased'", (expires, self.node_id))
+
+        self._transaction(_heartbeat)
+
+    def lease_target(self, url: str, output_path: str, min_interval: float = 0) -> bool:
+        """
+        Try to take the lease on a target. Fails if another node holds an unexpired lease or if the target
+        was polled less than `min_interval` seconds ago.
+        """
+
+        def _lease(cur, now):
+            cur.execute('INSERT OR IGNORE INTO targets (url, output_path) VALUES (?, ?)', (url, output_path))
+            cur.execute('UPDATE targets SET lease_owner = ?, lease_expires = ? '
+                        'WHERE url = ? AND output_path = ? '
+                        'AND (lease_owner IS NULL OR lease_owner = ? OR lease_expires < ?) '
+                        'AND (last_polled IS NULL OR last_polled <= ?)',
+                        (self.node_id, now + self.lease_time, url, output_path, self.node_id, now, now - min_interval))
+            return cur.rowcount == 1
+
+        return self._transaction(_lease)
+
+    def release_target(self, url: str, output_path: str, polled: bool = True):
+        def _release(cur, now):
+            if polled:
+                cur.execute('UPDATE targets SET lease_owner = NULL, lease_expires = NULL, last_polled = ? WHERE url = ? AND output_path = ? AND lease_owner = ?',
+                            (now, url, output_path, self.node_id))
+            else:
+                cur.execute('UPDATE targets SET lease_owner = NULL, lease_expires = NULL WHERE url = ? AND output_path = ? AND lease_owner = ?',
+                            (url, output_path, self.node_id))
+
+        self._transaction(_release)
+
+    def enqueue_videos(self, playlist_id: str, output_path: str, videos: list, requeue: bool = False) -> int:
+        """
+        Add videos to the shared queue. Videos that failed on every attempt get a fresh set of attempts, the same
+        way a single node retries videos missing from the archive every time it polls. Finished videos are left alone
+        unless `requeue` is set. Returns how many videos were queued.
+        """
+
+        def _enqueue(cur, now):
+            queued = 0
+            statuses = "('done', 'failed')" if requeue else "('failed')"
+            for video in videos:
+                cur.execute('INSERT OR IGNORE INTO videos (video_id, output_path, playlist_id, url, title, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                            (video['id'], output_path, str(playlist_id), video['url'], video.get('title'), now))
+                if cur.rowcount:
+                    queued += 1
+                else:
+                    cur.execute(f"UPDATE videos SET status = 'queued', attempts = 0, updated = ? WHERE video_id = ? AND output_path = ? AND status IN {statuses}",
+                                (now, video['id'], output_path))
+                    queued += cur.rowcount
+            return queued
+
+        return self._transaction(_enqueue)
+
+    def lease_videos(self, count: int = 1) -> list:
+        """
+        Lease up to `count` videos. Prioritized videos come first, then queued videos, then videos whose lease has
+        expired because the node holding them stopped sending heartbeats. Expired videos that have used up their
+        attempts are marked failed.
+        """
+
+        def _lease(cur, now):
+            cur.execute("UPDATE videos SET status = 'failed', lease_owner = NULL, lease_expires = NULL, updated = ? "
+                        "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?", (now, now, self.max_attempts))
+            rows = cur.execute("SELECT * FROM videos WHERE status = 'queued' OR (status = 'leased' AND lease_expires < ?) "
+                               "ORDER BY priority DESC, status DESC, updated LIMIT ?", (now, count)).fetchall()
+            for row in rows:
+                cur.execute("UPDATE videos SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE video_id = ? AND output_path = ?",
+                            (self.node_id, now + self.lease_time, now, row['video_id'], row['output_path']))
+            return [{
+                'video': {'id': row['video_id'], 'url': row['url'], 'title': row['title']},
+                'output_path': row['output_path'],
+                'playlist_id': row['playlist_id'],
+            } for row in rows]
+
+        return self._transaction(_lease)
+
+    def prioritize_videos(self, video_ids: list) -> int:
+        """
+        Move queued videos to the front of the shared queue. Returns how many videos were found.
+        """
+
+        def _prioritize(cur, now):
+            top = cur.execute('SELECT COALESCE(MAX(priority), 0) FROM videos').fetchone()[0]
+            found = 0
+            for video_id in video_ids:
+                cur.execute("UPDATE videos SET priority = ? WHERE video_id = ? AND status = 'queued'", (top + 1, video_id))
+                found += cur.rowcount
+            return found
+
+        return self._transaction(_prioritize)
+
+    def complete_video(self, video_id: str, output_path: str) -> bool:
+        """
+        Mark the video as downloaded. Returns False without changing anything if this node no longer holds the lease
+        because it expired and the video was handed to another node.
+        """
+
+        def _complete(cur, now):
+            cur.execute("UPDATE videos SET status = 'done', lease_owner = NULL, lease_expires = NULL, updated = ? "
+                        "WHERE video_id = ? AND output_path = ? AND lease_owner = ? AND status = 'leased'",
+                        (now, video_id, output_path, self.node_id))
+            return cur.rowcount == 1
+
+        return self._transaction(_complete)
+
+    def fail_video(self, video_id: str, output_path: str) -> bool:
+        """
+        Give the video back to the queue so another node can try it, or mark it failed if it's out of attempts.
+        Returns False without changing anything if this node no longer holds the lease.
+        """
+
+        def _fail(cur, now):
+            cur.execute("UPDATE videos SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                        "lease_owner = NULL, lease_expires = NULL, updated = ? "
+                        "WHERE video_id = ? AND output_path = ? AND lease_owner = ? AND status = 'leased'",
+                        (self.max_attempts, now, video_id, output_path, self.node_id))
+            return cur.rowcount == 1
+
+        return self._transaction(_fail)
+
+    def release(self):
+        """
+        Hand back every lease this node holds. Used on shutdown so other nodes don't have to wait for them to expire.
+        """
+
+        def _release(cur, now):
+            cur.execute('UPDATE targets SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?', (self.node_id,))
+            cur.execute("UPDATE videos SET status = 'queued', lease_owner = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0), updated = ? "
+                        "WHERE lease_owner = ? AND status = 'leased'", (now, self.node_id))
+            cur.execute('DELETE FROM nodes WHERE node_id = ?', (self.node_id,))
+
+        self._transaction(_release)
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) AS n FROM videos GROUP BY status').fetchall()
+        return {row['status']: row['n'] for row in rows}
+
+    def close(self):
+        self.release()
+        with self._lock:
+            self._conn.close()
+
+
+class Heartbeat(Thread):
+    """
+    Renews the node's leases in the background so long downloads don't lose their lease.
+    """
+
+    def __init__(self, job_store: JobStore, interval: float = None):
+        super().__init__(daemon=True)
+        self.job_store = job_store
+        self.interval = interval or job_store.lease_time / 3
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.job_store.heartbeat()
+            except sqlite3.Error:
+                # The shared storage might be briefly unavailable. The lease is long enough to survive a missed beat.
+                continue
+
+    def stop(self):
+        self.stopped.set()
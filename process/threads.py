@@ -91,12 +91,18 @@ def download_video(args) -> dict:
     try:
         kwargs['ydl_opts']['logger'] = ytdl_logger()  # dummy silent logger
         yt_dlp = ydl.YDL(kwargs['ydl_opts'])
+        format_reason = None
         try:
-            base_path = os.path.splitext(yt_dlp.prepare_filename(yt_dlp.extract_info(video['url'], download=False)))[0]
+            info = yt_dlp.extract_info(video['url'], download=False)
+            base_path = os.path.splitext(yt_dlp.prepare_filename(info))[0]
+            format_reason = info.get('format_policy')
         except AttributeError:
             # Sometimes we won't be able to pull the video info so just use the video's ID.
             base_path = kwargs['output_dir'] / video['id']
         ylogger = ytdl_logger(setup_file_logger(video['id'], str(base_path) + '.log'))
+        if format_reason:
+            ylogger.info(f'Format policy {format_reason}')
+            output_dict['logger_msg'].append(f"{video['id']} format policy {format_reason}")
         kwargs['ydl_opts']['logger'] = ylogger
         yt_dlp = ydl.YDL(kwargs['ydl_opts'])  # recreate the object with the correct logging path
         error_code = yt_dlp(video['url'])  # Do the download
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from appdirs import user_data_dir
+
+from ydl.files import create_directories, resolve_path
+from ydl.scan import scan_library
+
+parser = argparse.ArgumentParser(description='Find the videos that are already downloaded by scanning the output directories. Use this to rebuild a lost download archive.')
+parser.add_argument('directories', nargs='+', help='Output directories to scan. Subdirectories are scanned too.')
+parser.add_argument('--archive', default=None, help='Download archive (<playlist ID>.log in the --download-cache-file-directory) to add the found video IDs to. If not set, the IDs are printed.')
+parser.add_argument('--incremental', action='store_true', help="Only rescan directories that changed since the last incremental scan.")
+parser.add_argument('--cache-file', default=None, help='Where to keep the results for --incremental. Defaults to your appdata path.')
+parser.add_argument('--workers', type=int, default=32, help='How many directories to scan at once.')
+args = parser.parse_args()
+
+cache_file = None
+if args.incremental:
+    cache_file = resolve_path(args.cache_file or (user_data_dir('automated-youtube-dl', 'cyberes') + '/library-scan.json'))
+    create_directories(cache_file.parent)
+
+results = scan_library(*[resolve_path(x) for x in args.directories], workers=args.workers, cache_file=cache_file)
+complete = set().union(*[x['complete'] for x in results.values()])
+incomplete = set().union(*[x['incomplete'] for x in results.values()])
+print(f'Found {len(complete)} complete and {len(incomplete)} incomplete videos.', file=sys.stderr)
+
+if args.archive:
+    archive = resolve_path(args.archive)
+    existing = set()
+    if archive.exists():
+        with open(archive, 'r') as file:
+            existing.update([line.rstrip() for line in file])
+    new = sorted(complete - existing)
+    with open(archive, 'a') as file:
+        file.writelines(f'{video_id}\n' for video_id in new)
+    print(f'Added {len(new)} videos to {archive}', file=sys.stderr)
+else:
+    for video_id in sorted(complete):
+        print(video_id)
@@ -0,0 +1,207 @@
+from typing import Union
+
+from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.utils import ExtractorError
+
+# Same preferences as the old `format` string: AV1 and VP9 at 1080p, then 720p, high frame rates first.
+DEFAULT_POLICY = {
+    'max_size': 1100,  # MB, video and audio together
+    'heights': [1080, 720],  # minimum heights, best first
+    'video_codecs': ['av01', 'vp9.2', 'vp9'],  # best first, matched by prefix
+    'high_fps': 30,  # formats above this frame rate are preferred
+    'audio_codecs': ['opus'],  # best first, any audio codec is used if none of these are available
+    'allow_unknown_size': False,  # allow formats whose size can't be known or estimated before the fallback
+}
+
+
+def is_absent(codec: Union[str, None]) -> bool:
+    # yt-dlp uses the string 'none' for a stream that isn't there and None for a codec it doesn't know.
+    return codec == 'none'
+
+
+def normalize_codec(codec: Union[str, None]) -> str:
+    if codec is None:
+        return 'unknown'
+    codec = codec.lower()
+    # YouTube reports VP9 with its profile, e.g. vp09.00.51.08 or vp09.02.51.10 for HDR.
+    if codec.startswith('vp09.02'):
+        return 'vp9.2'
+    if codec.startswith('vp09'):
+        return 'vp9'
+    return codec
+
+
+def codec_matches(codec: str, wanted: str) -> bool:
+    codec = normalize_codec(codec)
+    return codec == wanted or codec.startswith(wanted + '.')
+
+
+def estimate_size(fmt: dict) -> tuple:
+    """
+    Returns the size of a format in bytes and where that number came from. When the site doesn't report a size, it's
+    estimated from the bitrate and the video's duration. The size is None if there isn't enough information.
+    """
+    if fmt.get('filesize'):
+        return fmt['filesize'], 'filesize'
+    if fmt.get('filesize_approx'):
+        return fmt['filesize_approx'], 'filesize_approx'
+    tbr = fmt.get('tbr') or ((fmt.get('vbr') or 0) + (fmt.get('abr') or 0))
+    if tbr and fmt.get('duration'):
+        return int(tbr * 1000 / 8 * fmt['duration']), 'tbr x duration'
+    return None, 'unknown'
+
+
+def format_mb(size: Union[int, None]) -> str:
+    return '? MB' if size is None else f'{round(size / 1e+6, 1)} MB'
+
+
+class FormatPolicy:
+    """
+    A format selector for yt-dlp's `format` option, compiled once from a policy config (see DEFAULT_POLICY).
+    Candidates are checked against the size cap before anything is downloaded. If the best format of a tier is
+    too big the next format down is tried, and if nothing fits the video is rejected.
+    """
+
+    def __init__(self, config: dict = None, merge_output_format: str = 'mkv'):
+        if config is not None and not isinstance(config, dict):
+            raise ValueError('The format policy must be a mapping of options')
+        unknown = set((config or {}).keys()) - set(DEFAULT_POLICY.keys())
+        if unknown:
+            raise ValueError(f'Unknown format policy options: {", ".join(sorted(unknown))}')
+        self.config = dict(DEFAULT_POLICY, **(config or {}))
+        self.validate(self.config)
+        self.max_bytes = int(self.config['max_size'] * 1e+6)
+        self.merge_output_format = merge_output_format
+
+        # Each tier is (minimum height, video codec, high frame rate only) in the order they're tried.
+        self.tiers = []
+        for height in self.config['heights']:
+            self.tiers += [(height, codec, True) for codec in self.config['video_codecs']]
+            self.tiers += [(height, codec, False) for codec in self.config['video_codecs']]
+            self.tiers.append((height, None, False))
+        self.tiers.append((0, None, False))
+
+    @staticmethod
+    def validate(config: dict):
+        def is_number(value):
+            # bool is a subclass of int but `max_size: true` is a mistake.
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+        for key in ('max_size', 'high_fps'):
+            if not is_number(config[key]):
+                raise ValueError(f'{key} must be a number, got {config[key]!r}')
+        if config['max_size'] <= 0:
+            raise ValueError(f'max_size must be greater than 0, got {config["max_size"]!r}')
+        if not isinstance(config['heights'], list) or not all(is_number(x) for x in config['heights']):
+            raise ValueError(f'heights must be a list of numbers, got {config["heights"]!r}')
+        for key in ('video_codecs', 'audio_codecs'):
+            if not isinstance(config[key], list) or not all(isinstance(x, str) for x in config[key]):
+                raise ValueError(f'{key} must be a list of codec names, got {config[key]!r}')
+        if not isinstance(config['allow_unknown_size'], bool):
+            raise ValueError(f'allow_unknown_size must be true or false, got {config["allow_unknown_size"]!r}')
+
+    def describe_tier(self, tier: tuple) -> str:
+        height, codec, high_fps = tier
+        desc = f'{codec or "any codec"} at {height}p or higher' if height else f'{codec or "any codec"} at any height'
+        if high_fps:
+            desc += f' above {self.config["high_fps"]} fps'
+        return desc
+
+    def matches_tier(self, fmt: dict, tier: tuple) -> bool:
+        height, codec, high_fps = tier
+        if (fmt.get('height') or 0) < height:
+            return False
+        if codec and not codec_matches(fmt.get('vcodec'), codec):
+            return False
+        if high_fps and (fmt.get('fps') or 0) <= self.config['high_fps']:
+            return False
+        return True
+
+    def fits(self, size: Union[int, None], allow_unknown: bool = None) -> bool:
+        if size is None:
+            return self.config['allow_unknown_size'] if allow_unknown is None else allow_unknown
+        return size <= self.max_bytes
+
+    def select_audio(self, formats: list) -> Union[dict, None]:
+        audio = [f for f in formats if not is_absent(f.get('acodec')) and is_absent(f.get('vcodec'))]
+        for codec in self.config['audio_codecs']:
+            preferred = [f for f in audio if codec_matches(f.get('acodec'), codec)]
+            if preferred:
+                return preferred[-1]
+        return audio[-1] if audio else None
+
+    def __call__(self, ctx: dict):
+        # yt-dlp sorts the formats from worst to best.
+        formats = ctx['formats']
+        video_only = [f for f in reversed(formats) if not is_absent(f.get('vcodec')) and is_absent(f.get('acodec'))]
+        combined = [f for f in reversed(formats) if not is_absent(f.get('vcodec')) and not is_absent(f.get('acodec'))]
+        # Like yt-dlp's `best`, use any format when none have both video and audio (e.g. audio-only sites).
+        fallback = combined or list(reversed(formats))
+        rejected = {}
+
+        audio = self.select_audio(formats)
+        if audio:
+            audio_size, _ = estimate_size(audio)
+            for tier in self.tiers:
+                for fmt in video_only:
+                    if not self.matches_tier(fmt, tier):
+                        continue
+                    size, source = estimate_size(fmt)
+                    total = None if size is None else size + (audio_size or 0)
+                    if not self.fits(total):
+                        rejected[fmt['format_id']] = format_mb(total)
+                        continue
+                    yield self.merge(fmt, audio, self.reason(fmt, total, source, self.describe_tier(tier), rejected))
+                    return
+
+        # Like the old `/best`, the fallback takes a format whose size isn't known, but only if no format with a
+        # known size fits.
+        for allow_unknown in (False, True):
+            for fmt in fallback:
+                size, source = estimate_size(fmt)
+                if not self.fits(size, allow_unknown):
+                    rejected[fmt['format_id']] = format_mb(size)
+                    continue
+                rejected.pop(fmt['format_id'], None)
+                yield dict(fmt, format_policy=self.reason(fmt, size, source, 'fallback to the best single format', rejected))
+                return
+
+        if not formats:
+            raise ExtractorError('No formats are available', expected=True)
+        raise ExtractorError(f'No format is smaller than {self.config["max_size"]} MB, rejected: {self.describe_rejected(rejected)}', expected=True)
+
+    def merge(self, video: dict, audio: dict, reason: str) -> dict:
+        return {
+            'format_id': f'{video["format_id"]}+{audio["format_id"]}',
+            'ext': self.merge_output_format,
+            'requested_formats': [video, audio],
+            'protocol': f'{video.get("protocol")}+{audio.get("protocol")}',
+            'width': video.get('width'),
+            'height': video.get('height'),
+            'fps': video.get('fps'),
+            'vcodec': video.get('vcodec'),
+            'acodec': audio.get('acodec'),
+            'format_policy': reason,
+        }
+
+    @staticmethod
+    def describe_rejected(rejected: dict) -> str:
+        return ', '.join(f'{format_id} ({size})' for format_id, size in rejected.items()) or 'none'
+
+    def reason(self, fmt: dict, size: Union[int, None], source: str, rule: str, rejected: dict) -> str:
+        msg = f'chose {fmt["format_id"]} ({fmt.get("height") or "?"}p {normalize_codec(fmt.get("vcodec"))}, {format_mb(size)} from {source}) for rule "{rule}"'
+        if rejected:
+            msg += f', rejected as too big or of unknown size: {self.describe_rejected(rejected)}'
+        return msg
+
+
+class FormatPolicyAnnotator(PostProcessor):
+    """
+    yt-dlp doesn't pass the video's duration to format selectors. This copies it to every format before formats
+    are selected so FormatPolicy can estimate sizes from the bitrate.
+    """
+
+    def run(self, info):
+        for fmt in info.get('formats') or []:
+            fmt.setdefault('duration', info.get('duration'))
+        return [], info
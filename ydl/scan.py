@@ -0,0 +1,210 @@
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Union
+
+# Every file we write starts with the video ID, see `base_outtempl` in downloader.py.
+ID_REGEX = re.compile(r'^\[([^\]]+)\] ')
+
+# Leftovers from a download or postprocessor that didn't finish.
+# `.fNNN.ext` files are the separate video and audio streams before they're merged.
+PARTIAL_REGEX = re.compile(r'(\.part|\.part-Frag\d+|\.ytdl|\.temp\.\w+|\.f\d+(-\d+)?\.\w+)$')
+
+# The first bytes of each container. Files without a known signature are only checked for their size.
+MAGIC = {
+    '.mkv': (0, b'\x1a\x45\xdf\xa3'),
+    '.webm': (0, b'\x1a\x45\xdf\xa3'),
+    '.mp4': (4, b'ftyp'),
+    '.m4a': (4, b'ftyp'),
+    '.mov': (4, b'ftyp'),
+    '.ogg': (0, b'OggS'),
+    '.opus': (0, b'OggS'),
+}
+MEDIA_EXTENSIONS = set(MAGIC.keys()) | {'.mp3', '.flv', '.3gp', '.avi', '.wav', '.aac'}
+
+# How many media files one worker checks at a time. Big directories are split so every worker gets some.
+CHECK_BATCH_SIZE = 256
+
+
+def is_valid_media(path: Union[str, Path], size: int) -> bool:
+    if size <= 0:
+        return False
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in MAGIC:
+        return True
+    offset, magic = MAGIC[ext]
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(offset + len(magic))
+    except OSError:
+        return False
+    return header[offset:] == magic
+
+
+def check_media_batch(files: list) -> list:
+    return [is_valid_media(path, size) for path, size in files]
+
+
+def scan_directory(path: Union[str, Path]) -> dict:
+    """
+    List a single directory. The media files aren't opened here so their headers can be checked in parallel.
+    """
+    # Read the mtime before listing so a file added during the listing makes the next incremental scan read the
+    # directory again instead of caching the new mtime without the new file.
+    mtime_ns = os.stat(path).st_mtime_ns
+    media, info_json, partial, subdirs = {}, set(), set(), []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            m = ID_REGEX.match(entry.name)
+            if not m:
+                continue
+            video_id = m.group(1)
+            if PARTIAL_REGEX.search(entry.name):
+                partial.add(video_id)
+            elif entry.name.endswith('.info.json'):
+                info_json.add(video_id)
+            elif os.path.splitext(entry.name)[1].lower() in MEDIA_EXTENSIONS:
+                st = entry.stat()
+                media[entry.name] = [video_id, st.st_size, st.st_mtime_ns, None]
+    return {
+        'mtime_ns': mtime_ns,
+        'media': media,  # name: [video ID, size, mtime, valid]
+        'info_json': sorted(info_json),
+        'partial': sorted(partial),
+        'subdirs': subdirs,
+    }
+
+
+def summarize_directory(scanned: dict):
+    """
+    A video is complete when it has a valid media file, a `.info.json`, and no partial files left over.
+    """
+    valid_media = {video_id for video_id, _, _, valid in scanned['media'].values() if valid}
+    complete = (valid_media & set(scanned['info_json'])) - set(scanned['partial'])
+    incomplete = ({x[0] for x in scanned['media'].values()} | set(scanned['info_json']) | set(scanned['partial'])) - complete
+    scanned['complete'] = sorted(complete)
+    scanned['incomplete'] = sorted(incomplete)
+    return scanned
+
+
+def load_scan_cache(cache_file: Union[str, Path, None]) -> dict:
+    if not cache_file or not Path(cache_file).exists():
+        return {}
+    try:
+        with open(cache_file, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # A broken cache only costs us a full scan.
+        return {}
+
+
+def save_scan_cache(cache_file: Union[str, Path], cache: dict):
+    # A unique temp file so two processes saving at once don't write to the same file. The last one to finish wins.
+    fd, tmp = tempfile.mkstemp(dir=Path(cache_file).parent, prefix=f'{Path(cache_file).name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file:
+            json.dump(cache, file)
+        os.replace(tmp, cache_file)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def scan_library(*directories: Union[str, Path], workers: int = 32, cache_file: Union[str, Path, None] = None) -> dict:
+    """
+    Walk the directories in parallel and find which videos are on disk. Returns `{directory: {'complete': set, 'incomplete': set}}`.
+    When `cache_file` is set the scan is incremental: a directory whose modification time hasn't changed since the last
+    scan isn't read again. Adding, removing, or renaming a file (which is how yt-dlp finishes a download) changes it.
+    In a directory that changed, only media files whose size or modification time changed are opened again.
+    """
+    old_cache = load_scan_cache(cache_file)
+    new_cache = {}
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        listings = {}  # (directory, root): listing that is waiting for its media files to be checked
+        unchecked = {}  # (directory, root): how many batches of its media files are still being checked
+
+        def visit(path, root):
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                return
+            cached = old_cache.get(path)
+            if cached and cached['mtime_ns'] == mtime_ns and 'media' in cached:
+                collect(path, root, cached)
+            else:
+                futures[executor.submit(scan_directory, path)] = ('directory', path, root, None)
+
+        def check_media(path, root, scanned):
+            # Only open the files that are new or changed since the last scan.
+            cached_media = old_cache.get(path, {}).get('media', {})
+            key = (path, root)
+            unchecked[key] = 0
+            changed = []
+            for name, (video_id, size, mtime_ns, _) in scanned['media'].items():
+                cached = cached_media.get(name)
+                if cached and cached[:3] == [video_id, size, mtime_ns]:
+                    scanned['media'][name][3] = cached[3]
+                else:
+                    changed.append(name)
+            for i in range(0, len(changed), CHECK_BATCH_SIZE):
+                names = changed[i:i + CHECK_BATCH_SIZE]
+                files = [(os.path.join(path, name), scanned['media'][name][1]) for name in names]
+                futures[executor.submit(check_media_batch, files)] = ('files', path, root, names)
+                unchecked[key] += 1
+            if unchecked[key]:
+                listings[key] = scanned
+            else:
+                del unchecked[key]
+                collect(path, root, summarize_directory(scanned))
+
+        def collect(path, root, scanned):
+            new_cache[path] = scanned
+            results[root]['complete'].update(scanned['complete'])
+            results[root]['incomplete'].update(scanned['incomplete'])
+            for subdir in scanned['subdirs']:
+                visit(subdir, root)
+
+        for directory in directories:
+            root = str(directory)
+            results[root] = {'complete': set(), 'incomplete': set()}
+            visit(root, root)
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, path, root, names = futures.pop(future)
+                if kind == 'directory':
+                    try:
+                        scanned = future.result()
+                    except OSError:
+                        # The directory was removed or can't be read.
+                        continue
+                    check_media(path, root, scanned)
+                else:
+                    key = (path, root)
+                    for name, valid in zip(names, future.result()):
+                        listings[key]['media'][name][3] = valid
+                    unchecked[key] -= 1
+                    if not unchecked[key]:
+                        del unchecked[key]
+                        collect(path, root, summarize_directory(listings.pop(key)))
+
+    for result in results.values():
+        # A video that is complete in one directory doesn't need to be downloaded again because of a leftover in another.
+        result['incomplete'] -= result['complete']
+    if cache_file:
+        # Keep the directories outside the scanned roots so scanning one directory doesn't wipe the cache of the others.
+        roots = [str(directory) for directory in directories]
+        for path, cached in old_cache.items():
+            if not any(path == root or path.startswith(os.path.join(root, '')) for root in roots):
+                new_cache[path] = cached
+        save_scan_cache(cache_file, new_cache)
+    return results
@@ -5,11 +5,15 @@ from typing import Union
 import yt_dlp
 from mergedeep import merge
 
+from ydl.formats import FormatPolicy, FormatPolicyAnnotator
+
 
 class YDL:
     def __init__(self, ydl_opts):
         self.ydl_opts = ydl_opts
         self.yt_dlp = yt_dlp.YoutubeDL(ydl_opts)
+        if isinstance(ydl_opts.get('format'), FormatPolicy):
+            self.yt_dlp.add_post_processor(FormatPolicyAnnotator(), when='pre_process')
 
     def get_formats(self, url: Union[str, Path]) -> tuple:
         """